@@ -34,7 +34,8 @@ class JointDataset(torch.utils.data.Dataset):
 		self.rna_data = self.create_tensor(rna_data)
 		# self.size_factors = self.rna_data.sum(1)
 
-		self.tcr_data = torch.LongTensor(tcr_data)
+		# token ids may be stored as small integer types, converting them copies only once
+		self.tcr_data = torch.from_numpy(np.asarray(tcr_data, dtype=np.int64))
 
 		if labels is not None:
 			self.labels = torch.LongTensor(self.labels)
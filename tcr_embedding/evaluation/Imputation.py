@@ -7,7 +7,7 @@ import scanpy as sc
 
 
 def run_imputation_evaluation(data_full, embedding_function, query_source='val',
-                              num_neighbors=5, label_pred='binding_name'):
+                              num_neighbors=5, label_pred='binding_name', knn_backend='sklearn'):
     """
     Function for evaluating the embedding quality based upon imputation in the 10x dataset
     :param data_full: anndata object containing the full cell data (TCR + Genes) (train, val, test)
@@ -15,6 +15,7 @@ def run_imputation_evaluation(data_full, embedding_function, query_source='val',
     :param query_source: str 'val' or 'test' to choose between evaluation mode
     :param num_neighbors: amount of neighbors for knn classification
     :param label_pred: label of the collumn used for prediction
+    :param knn_backend: 'sklearn' or 'faiss' used for the knn search
     :return: dictionary {metric: summary} containing the evaluation scores
     """
     data_atlas = data_full[data_full.obs['set'] == 'train']
@@ -27,11 +28,12 @@ def run_imputation_evaluation(data_full, embedding_function, query_source='val',
 
     scores = get_imputation_scores(embedding_atlas, embedding_query,
                                    data_atlas.obs[label_pred], data_query.obs[label_pred],
-                                   num_neighbors=num_neighbors)
+                                   num_neighbors=num_neighbors, knn_backend=knn_backend)
     return scores
 
 
-def get_imputation_scores(embedding_atlas, embedding_query, label_atlas, label_embedding, num_neighbors=5):
+def get_imputation_scores(embedding_atlas, embedding_query, label_atlas, label_embedding, num_neighbors=5,
+                          knn_backend='sklearn'):
     """
     Calculate evaluation scores based on imputation, so far knn classification report and Recall@k
     :param embedding_atlas: numpy array (num cells, hidden dim) of the atlas dataset
@@ -39,6 +41,7 @@ def get_imputation_scores(embedding_atlas, embedding_query, label_atlas, label_e
     :param label_atlas: epitope specificity by cell of the atlas
     :param label_embedding: epitope specificity by cell of the query set
     :param num_neighbors: amount of neighbors used for knn classification
+    :param knn_backend: 'sklearn' or 'faiss' used for the knn search
     :return: dictionary {metric_name: metric_score}
     """
     summary = {}
@@ -50,7 +53,7 @@ def get_imputation_scores(embedding_atlas, embedding_query, label_atlas, label_e
 
     # kNN score
     knn_score = Metrics.get_knn_classification(embedding_atlas, embedding_query, label_atlas, label_embedding,
-                                           num_neighbors=num_neighbors, weights='distance')
+                                           num_neighbors=num_neighbors, weights='distance', backend=knn_backend)
     summary['knn'] = knn_score
     return summary
 
@@ -12,26 +12,73 @@ from sklearn.metrics import normalized_mutual_info_score, adjusted_rand_score
 from scipy import stats
 
 
-def get_knn_classification(data_atlas, data_query, labels_atlas, labels_query, num_neighbors=5, weights='distance'):
+def get_knn_classification(data_atlas, data_query, labels_atlas, labels_query, num_neighbors=5, weights='distance',
+                           backend='sklearn'):
     """
-    Evaluates with kNN based on scikit-learn
+    Evaluates with kNN based on scikit-learn or FAISS
     :param data_atlas: numpy array (num_cells, hidden_size) embeddings of the atlas data
     :param data_query: numpy array (num_cells, hidden_size) embeddings of the query data
     :param labels_atlas: list (num_cells) labels of the atlas data
     :param labels_query: list (num_cells) labels of the query data
     :param num_neighbors: amount of neighbors used for kNN
     :param weights: kNN weighting,
+    :param backend: 'sklearn' or 'faiss', faiss runs the neighbor search on the GPU if available
     :return:
     """
-
-    clf = KNeighborsClassifier(num_neighbors, weights)
-    clf.fit(data_atlas, labels_atlas)
-
-    labels_predicted = clf.predict(data_query)
+    if backend == 'faiss':
+        labels_predicted = get_knn_prediction_faiss(data_atlas, data_query, labels_atlas, num_neighbors, weights)
+    elif backend == 'sklearn':
+        clf = KNeighborsClassifier(num_neighbors, weights)
+        clf.fit(data_atlas, labels_atlas)
+        labels_predicted = clf.predict(data_query)
+    else:
+        raise ValueError(f'Unknown kNN backend: {backend}')
     report = classification_report(labels_query, labels_predicted, output_dict=True)
     return report
 
 
+def get_knn_prediction_faiss(data_atlas, data_query, labels_atlas, num_neighbors=5, weights='distance'):
+    """
+    kNN classification with an exact FAISS index, votes are weighted like scikit-learn's KNeighborsClassifier
+    :param data_atlas: numpy array (num_cells, hidden_size) embeddings of the atlas data
+    :param data_query: numpy array (num_cells, hidden_size) embeddings of the query data
+    :param labels_atlas: list (num_cells) labels of the atlas data
+    :param num_neighbors: amount of neighbors used for kNN
+    :param weights: 'uniform' or 'distance'
+    :return: numpy array (num_cells) predicted labels of the query data
+    """
+    import faiss  # optional dependency
+
+    data_atlas = np.ascontiguousarray(data_atlas, dtype=np.float32)
+    data_query = np.ascontiguousarray(data_query, dtype=np.float32)
+    # FAISS pads missing neighbors with index -1, which would vote for the last atlas label
+    if num_neighbors > len(data_atlas):
+        raise ValueError(f'Expected num_neighbors <= atlas size, got {num_neighbors} > {len(data_atlas)}')
+    index = faiss.IndexFlatL2(data_atlas.shape[1])
+    if hasattr(faiss, 'StandardGpuResources') and faiss.get_num_gpus() > 0:
+        index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, index)
+    index.add(data_atlas)
+    squared_dist, neighbors = index.search(data_query, num_neighbors)
+
+    classes, labels_idx = np.unique(np.asarray(labels_atlas), return_inverse=True)
+    if weights == 'distance':
+        with np.errstate(divide='ignore'):
+            vote_weights = 1. / np.sqrt(np.maximum(squared_dist, 0))
+        # exact matches get all the weight, same as in scikit-learn
+        inf_mask = np.isinf(vote_weights)
+        inf_row = np.any(inf_mask, axis=1)
+        vote_weights[inf_row] = inf_mask[inf_row]
+    elif weights == 'uniform':
+        vote_weights = np.ones_like(squared_dist)
+    else:
+        raise ValueError(f'Unknown kNN weighting: {weights}')
+
+    votes = np.zeros((len(data_query), len(classes)))
+    rows = np.repeat(np.arange(len(data_query)), neighbors.shape[1])
+    np.add.at(votes, (rows, labels_idx[neighbors].ravel()), vote_weights.ravel())
+    return classes[votes.argmax(axis=1)]
+
+
 def get_silhouette_scores(embeddings, labels_predicted):
     """
     Calculates the Silhouette score as internal cluster evaluation
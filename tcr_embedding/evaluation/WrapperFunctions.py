@@ -1,12 +1,13 @@
 import numpy as np
 
 
-def get_model_prediction_function(model, do_adata=False, metadata=None):
+def get_model_prediction_function(model, do_adata=False, metadata=None, compiled=False):
     """
     Wrapper function for our embedding models
     :param model: trained pytorch model
     :param do_adata: return the adata object (else numpy array)
     :param metadata: add these .obs from the original to the created anndata object
+    :param compiled: use the compiled encoder-only module of the model for the latent space calculation
     :return: function for calculating the latent space of cells in an anndata object
     """
     def prediction_function(data):
@@ -16,7 +17,7 @@ def get_model_prediction_function(model, do_adata=False, metadata=None):
         :return: numpy array (num_cells, hidden_dim) latent embedding for each cell
         """
         metadata_tmp = metadata if metadata is not None else []
-        latent_space = model.get_latent(data, metadata=metadata_tmp, return_mean=True)
+        latent_space = model.get_latent(data, metadata=metadata_tmp, return_mean=True, compiled=compiled)
         if do_adata:
             return latent_space
         latent_space = latent_space.X
@@ -72,6 +72,32 @@ class MLP(nn.Module):
         return outputs
 
 
+def forward_parallel(mlps, inputs):
+    """
+    Forward MLPs with identical architecture at once, their linear layers run as a single batched matmul
+    :param mlps: list of MLP with the same layer structure, each keeps its own parameters
+    :param inputs: list of torch.Tensor with the same shape, one input per MLP
+    :return: list of torch.Tensor, the output of each MLP
+    """
+    x = torch.stack(inputs, dim=0)  # shape=[n_mlps, batch_size, n_inputs]
+    for blocks in zip(*[mlp.network for mlp in mlps]):
+        for layers in zip(*blocks):
+            if isinstance(layers[0], nn.Linear):
+                weight = torch.stack([layer.weight for layer in layers], dim=0).transpose(1, 2)
+                if layers[0].bias is not None:
+                    bias = torch.stack([layer.bias for layer in layers], dim=0).unsqueeze(1)
+                    x = torch.baddbmm(bias, x, weight)
+                else:
+                    x = torch.bmm(x, weight)
+            elif isinstance(layers[0], nn.BatchNorm1d):  # statistics are tracked per MLP
+                x = torch.stack([layer(x_) for layer, x_ in zip(layers, x.unbind(0))], dim=0)
+            elif isinstance(layers[0], (nn.ReLU, nn.LeakyReLU, nn.Sigmoid, Exponential, nn.Dropout)):
+                x = layers[0](x)  # elementwise and identical for all MLPs
+            else:  # e.g. softmax, which would normalize over the stacked MLPs
+                x = torch.stack([layer(x_) for layer, x_ in zip(layers, x.unbind(0))], dim=0)
+    return list(x.unbind(0))
+
+
 class Exponential(nn.Module):
     def __init__(self):
         super().__init__()
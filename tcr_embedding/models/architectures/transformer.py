@@ -1,3 +1,4 @@
+import inspect
 import math
 import torch
 import torch.nn as nn
@@ -38,26 +39,45 @@ class TransformerEncoder(nn.Module):
         self.params = params
 
         self.num_seq_labels = num_seq_labels
+        # exclude the padding of each sequence from the attention
+        self.mask_padding = 'mask_padding' in params and params['mask_padding']
 
         self.embedding = nn.Embedding(num_seq_labels, params['embedding_size'], padding_idx=0)
         self.positional_encoding = TrigonometricPositionalEncoding(params['embedding_size'],
                                                                    params['dropout'],
                                                                    params['max_tcr_length'])
 
+        # batch_first allows PyTorch to pack the masked sequences into nested tensors during inference (torch>=1.9)
+        self.batch_first = self.mask_padding and \
+            'batch_first' in inspect.signature(nn.TransformerEncoderLayer).parameters
+        layer_kwargs = {'batch_first': True} if self.batch_first else {}
         encoding_layers = nn.TransformerEncoderLayer(params['embedding_size'],
                                                      params['num_heads'],
                                                      params['embedding_size'] * params['forward_expansion'],
-                                                     params['dropout'])
+                                                     params['dropout'],
+                                                     **layer_kwargs)
         self.transformer_encoder = nn.TransformerEncoder(encoding_layers, params['encoding_layers'])
 
         self.fc_reduction = nn.Linear(params['max_tcr_length'] * params['embedding_size'], hdim)
 
     def forward(self, x, tcr_len):
+        if self.mask_padding:
+            # at least one position is kept, as fully masked sequences result in NaNs
+            positions = torch.arange(x.shape[1], device=x.device)
+            padding_mask = positions.unsqueeze(0) >= tcr_len.to(x.device).clamp(min=1).unsqueeze(1)
         x = self.embedding(x) * math.sqrt(self.num_seq_labels)
         x = x.transpose(0, 1)
         x = x + self.positional_encoding(x)
-        x = self.transformer_encoder(x)
-        x = x.transpose(0, 1)
+        if self.mask_padding:
+            if self.batch_first:
+                x = self.transformer_encoder(x.transpose(0, 1), src_key_padding_mask=padding_mask)
+            else:
+                x = self.transformer_encoder(x, src_key_padding_mask=padding_mask).transpose(0, 1)
+            # zero the padding, so training and the packed inference path agree
+            x = x.masked_fill(padding_mask.unsqueeze(-1), 0.)
+        else:
+            x = self.transformer_encoder(x)
+            x = x.transpose(0, 1)
         x = x.flatten(1)
         x = self.fc_reduction(x)
         return x
@@ -1,10 +1,11 @@
 # A Variational Information Bottleneck Approach to Multi-Omics Data Integration
+import contextlib
 import torch
 import torch.nn as nn
 import scanpy as sc
 
 from tcr_embedding.models.architectures.transformer import TransformerEncoder, TransformerDecoder
-from tcr_embedding.models.architectures.mlp import MLP
+from tcr_embedding.models.architectures.mlp import MLP, forward_parallel
 from tcr_embedding.models.architectures.mlp_scRNA import build_mlp_encoder, build_mlp_decoder
 from tcr_embedding.models.vae_base_model import VAEBaseModel
 from tcr_embedding.dataloader.DataLoader import initialize_prediction_loader
@@ -15,6 +16,9 @@ class MoEModelTorch(nn.Module):
 		super(MoEModelTorch, self).__init__()
 		self.beta_only = 'beta_only' in tcr_params and tcr_params['beta_only']
 		self.amount_chains = 1 if self.beta_only else 2
+		# encode alpha and beta chain with tied weights in a single batched pass
+		self.shared_chain_encoder = not self.beta_only and 'shared_chain_encoder' in tcr_params and \
+			tcr_params['shared_chain_encoder']
 
 		xdim = rna_params['xdim']
 		hdim = joint_params['hdim']
@@ -30,11 +34,15 @@ class MoEModelTorch(nn.Module):
 
 		num_seq_labels = tcr_params['num_seq_labels']
 
+		if self.shared_chain_encoder:
+			self.chain_encoder = TransformerEncoder(tcr_params, hdim // 2, num_seq_labels)
+		else:
+			if not self.beta_only:
+				self.alpha_encoder = TransformerEncoder(tcr_params, hdim // 2, num_seq_labels)
+			self.beta_encoder = TransformerEncoder(tcr_params, hdim // self.amount_chains, num_seq_labels)
+
 		if not self.beta_only:
-			self.alpha_encoder = TransformerEncoder(tcr_params, hdim // 2, num_seq_labels)
 			self.alpha_decoder = TransformerDecoder(tcr_params, hdim, num_seq_labels)
-
-		self.beta_encoder = TransformerEncoder(tcr_params, hdim // self.amount_chains, num_seq_labels)
 		self.beta_decoder = TransformerDecoder(tcr_params, hdim, num_seq_labels)
 
 		self.rna_encoder = build_mlp_encoder(rna_params, xdim, hdim)
@@ -64,13 +72,19 @@ class MoEModelTorch(nn.Module):
 		# used for NB loss
 		self.theta = torch.nn.Parameter(torch.randn(xdim))
 
-	def forward(self, rna, tcr, tcr_len, conditional=None):
+		# positions of the reconstruction targets, i.e. all except the first token of each chain
+		seq_len = tcr_params['max_tcr_length']
+		keep_idx = [i for i in range(seq_len * self.amount_chains) if i % seq_len != 0]
+		self.register_buffer('tcr_keep_idx', torch.tensor(keep_idx, dtype=torch.long), persistent=False)
+
+	def forward(self, rna, tcr, tcr_len, conditional=None, need_reconstruction=True):
 		"""
 		Forward pass of autoencoder
 		:param rna: torch.Tensor shape=[batch_size, num_genes]
 		:param tcr: torch.Tensor shape=[batch_size, seq_len, feature_dim]
 		:param tcr_len: torch.Tensor shape=[batch_size]
 		:param conditional: torch.Tensor shape=[batch_size, n_cond] one-hot-encoded conditional covariates
+		:param need_reconstruction: bool, if False the decoders are skipped and rna_pred, tcr_pred are None
 		:return:
 			z: list of sampled latent variable zs. z = [z_rna, z_tcr, z_joint]
 			mu: list of predicted means mu. mu = [mu_rna, mu_tcr, mu_joint]
@@ -78,63 +92,119 @@ class MoEModelTorch(nn.Module):
 			rna_pred: list of reconstructed rna. rna_pred = [rna_pred using z_rna, rna_pred using z_joint]
 			tcr_pred: list of reconstructed tcr. tcr_pred = [tcr_pred using z_tcr, tcr_pred using z_joint]
 		"""
-		if conditional is not None:
-			cond_emb_vec = self.cond_emb(conditional) if self.use_embedding_for_cond else torch.nn.functional.one_hot(conditional, self.num_conditional_labels)
-		# Encode TCR
+		cond_emb_vec = self.get_cond_emb_vec(conditional) if conditional is not None else None
+		mu, logvar, (alpha_seq, beta_seq) = self._encode(rna, tcr, tcr_len, cond_emb_vec)
 
-		beta_seq = tcr[:, tcr.shape[1] // 2 * (self.amount_chains == 2):]
-		beta_len = tcr_len[:, self.amount_chains - 1]
-		h_beta = self.beta_encoder(beta_seq, beta_len)  # shape=[batch_size, hdim//2]
+		z_rna = self.reparameterize(mu[0], logvar[0])  # shape=[batch_size, zdim]
+		z_tcr = self.reparameterize(mu[1], logvar[1])  # shape=[batch_size, zdim]
+		z = [z_rna, z_tcr]
+		if not need_reconstruction:
+			return z, mu, logvar, None, None
+
+		# Reconstruction
+		if conditional is not None:
+			z_cond = [torch.cat([z_, cond_emb_vec], dim=1) for z_ in z]  # shape=[batch_size, zdim+n_cond]
+		else:
+			z_cond = z
+		amount_z = len(z_cond)
+
+		# decode both latents in a single pass, BatchNorm statistics require separate passes during training
+		# the rna and tcr vae decoders share their input and run as one batched pass
+		vae_decoders = [self.rna_vae_decoder, self.tcr_vae_decoder]
+		if self.training:
+			f_rna, f_tcr = zip(*[forward_parallel(vae_decoders, [z_, z_]) for z_ in z_cond])
+			rna_pred = [self.rna_decoder(f_) for f_ in f_rna]
+			f_tcr = torch.cat(f_tcr, dim=0)
+		else:
+			z_batched = torch.cat(z_cond, dim=0)  # shape=[amount_z*batch_size, zdim+n_cond]
+			f_rna, f_tcr = forward_parallel(vae_decoders, [z_batched, z_batched])
+			rna_pred = list(self.rna_decoder(f_rna).chunk(amount_z, dim=0))
 
+		beta_pred = self.beta_decoder(f_tcr, beta_seq.repeat(amount_z, 1))
 		if not self.beta_only:
-			alpha_seq = tcr[:, :tcr.shape[1] // 2]
-			alpha_len = tcr_len[:, 0]
-			h_alpha = self.alpha_encoder(alpha_seq, alpha_len)  # shape=[batch_size, hdim//2]
-			h_tcr = torch.cat([h_alpha, h_beta], dim=-1)  # shape=[batch_size, hdim]
+			alpha_pred = self.alpha_decoder(f_tcr, alpha_seq.repeat(amount_z, 1))
+			tcr_pred = torch.cat([alpha_pred, beta_pred], dim=1)
+		else:
+			tcr_pred = beta_pred
+		tcr_pred = list(tcr_pred.chunk(amount_z, dim=0))
+		return z, mu, logvar, rna_pred, tcr_pred
+
+	def encode(self, rna, tcr, tcr_len, conditional=None):
+		"""
+		Encode both modalities without sampling or decoding, used for latent space extraction
+		:param rna: torch.Tensor shape=[batch_size, num_genes]
+		:param tcr: torch.Tensor shape=[batch_size, seq_len]
+		:param tcr_len: torch.Tensor shape=[batch_size, amount_chains]
+		:param conditional: None or torch.LongTensor shape=[batch_size] conditional labels
+		:return:
+			mu: list of predicted means mu. mu = [mu_rna, mu_tcr]
+			logvar: list of predicted logvars. logvar = [logvar_rna, logvar_tcr]
+		"""
+		cond_emb_vec = self.get_cond_emb_vec(conditional) if conditional is not None else None
+		mu, logvar, _ = self._encode(rna, tcr, tcr_len, cond_emb_vec)
+		return mu, logvar
+
+	def _encode(self, rna, tcr, tcr_len, cond_emb_vec=None):
+		"""
+		Encode both modalities into the parameters of their latent distributions
+		:param rna: torch.Tensor shape=[batch_size, num_genes]
+		:param tcr: torch.Tensor shape=[batch_size, seq_len]
+		:param tcr_len: torch.Tensor shape=[batch_size, amount_chains]
+		:param cond_emb_vec: None or torch.Tensor shape=[batch_size, cond_dim] embedded conditional covariates
+		:return:
+			mu: list of predicted means mu. mu = [mu_rna, mu_tcr]
+			logvar: list of predicted logvars. logvar = [logvar_rna, logvar_tcr]
+			(alpha_seq, beta_seq): views on the chains of the tcr input, alpha_seq is None for beta only models
+		"""
+		# Encode TCR
+		if self.beta_only:
+			alpha_seq, beta_seq = None, tcr
+		else:
+			# split into both chains as views, shape=[batch_size, seq_len//2] each
+			alpha_seq, beta_seq = tcr.view(tcr.size(0), 2, tcr.size(1) // 2, *tcr.shape[2:]).unbind(1)
+
+		if self.shared_chain_encoder:
+			# stack both chains along the batch, shape=[2*batch_size, seq_len//2]
+			h_chains = self.chain_encoder(torch.cat([alpha_seq, beta_seq], dim=0), tcr_len.t().flatten())
+			h_alpha, h_beta = h_chains.chunk(2, dim=0)  # shape=[batch_size, hdim//2] each
+			h_parts = [h_alpha, h_beta]
 		else:
-			h_tcr = torch.cat([h_beta], dim=-1)
+			beta_len = tcr_len[:, self.amount_chains - 1]
+			h_beta = self.beta_encoder(beta_seq, beta_len)  # shape=[batch_size, hdim//2]
+
+			h_parts = [h_beta]
+			if not self.beta_only:
+				alpha_len = tcr_len[:, 0]
+				h_alpha = self.alpha_encoder(alpha_seq, alpha_len)  # shape=[batch_size, hdim//2]
+				h_parts = [h_alpha, h_beta]
+		if cond_emb_vec is not None and self.cond_input:
+			h_parts.append(cond_emb_vec)
 
-		if conditional is not None and self.cond_input:
-			h_tcr = torch.cat([h_tcr, cond_emb_vec], dim=1)  # shape=[batch_size, hdim+n_cond]
+		h_tcr = torch.cat(h_parts, dim=-1)  # shape=[batch_size, hdim(+n_cond)]
 
 		# Encode RNA
 		h_rna = self.rna_encoder(rna)  # shape=[batch_size, hdim]
-		if conditional is not None and self.cond_input:
+		if cond_emb_vec is not None and self.cond_input:
 			h_rna = torch.cat([h_rna, cond_emb_vec], dim=1)  # shape=[batch_size, hdim+n_cond]
 
-		# Predict Latent space
-		z_rna_ = self.rna_vae_encoder(h_rna)  # shape=[batch_size, zdim*2]
-		mu_rna, logvar_rna = z_rna_[:, :z_rna_.shape[1] // 2], z_rna_[:, z_rna_.shape[1] // 2:]
-		z_rna = self.reparameterize(mu_rna, logvar_rna)  # shape=[batch_size, zdim]
+		# Predict Latent space, both encoders run as one batched pass, shape=[batch_size, zdim*2] each
+		z_rna_, z_tcr_ = forward_parallel([self.rna_vae_encoder, self.tcr_vae_encoder], [h_rna, h_tcr])
+		mu_rna, logvar_rna = z_rna_.view(z_rna_.shape[0], 2, -1).unbind(1)  # views, shape=[batch_size, zdim] each
+		mu_tcr, logvar_tcr = z_tcr_.view(z_tcr_.shape[0], 2, -1).unbind(1)
 
-		z_tcr_ = self.tcr_vae_encoder(h_tcr)  # shape=[batch_size, zdim*2]
-		mu_tcr, logvar_tcr = z_tcr_[:, :z_tcr_.shape[1] // 2], z_tcr_[:, z_tcr_.shape[1] // 2:]
-		z_tcr = self.reparameterize(mu_tcr, logvar_tcr)  # shape=[batch_size, zdim]
-
-		z = [z_rna, z_tcr]
 		mu = [mu_rna, mu_tcr]
 		logvar = [logvar_rna, logvar_tcr]
+		return mu, logvar, (alpha_seq, beta_seq)
 
-		# Reconstruction
-		rna_pred = []
-		for z_ in z:
-			if conditional is not None:
-				z_ = torch.cat([z_, cond_emb_vec], dim=1)  # shape=[batch_size, hdim+n_cond]
-			f_rna = self.rna_vae_decoder(z_)
-			rna_pred.append(self.rna_decoder(f_rna))
-		tcr_pred = []
-		for z_ in z:
-			if conditional is not None:
-				z_ = torch.cat([z_, cond_emb_vec], dim=1)  # shape=[batch_size, hdim+n_cond]
-			f_tcr = self.tcr_vae_decoder(z_)
-			beta_pred = self.beta_decoder(f_tcr, beta_seq)
-
-			if not self.beta_only:
-				alpha_pred = self.alpha_decoder(f_tcr, alpha_seq)
-				tcr_pred.append(torch.cat([alpha_pred, beta_pred], dim=1))
-			else:
-				tcr_pred.append(torch.cat([beta_pred], dim=1))
-		return z, mu, logvar, rna_pred, tcr_pred
+	def get_cond_emb_vec(self, conditional):
+		"""
+		Embed the conditional labels
+		:param conditional: torch.LongTensor shape=[batch_size] conditional labels
+		:return: torch.Tensor shape=[batch_size, cond_dim]
+		"""
+		if not self.use_embedding_for_cond:
+			return torch.nn.functional.one_hot(conditional, self.num_conditional_labels)
+		return self.cond_emb(conditional)
 
 	def reparameterize(self, mu, log_var):
 		"""
@@ -144,7 +214,7 @@ class MoEModelTorch(nn.Module):
 		"""
 		std = torch.exp(0.5 * log_var)  # standard deviation
 		eps = torch.randn_like(std)  # `randn_like` as we need the same size
-		z = mu + (eps * std)  # sampling as if coming from the input space
+		z = torch.addcmul(mu, eps, std)  # sampling as if coming from the input space, mu + eps * std in one kernel
 		return z
 
 	def predict_transcriptome(self, z_shared, conditional=None):
@@ -154,8 +224,17 @@ class MoEModelTorch(nn.Module):
 		:param conditional:
 		:return: torch.tensor, transcriptome profile
 		"""
-		if conditional is not None:  # more efficient than doing two concatenations
-			cond_emb_vec = self.cond_emb(conditional)
+		cond_emb_vec = self.get_cond_emb_vec(conditional) if conditional is not None else None
+		return self.predict_transcriptome_from_embed(z_shared, cond_emb_vec)
+
+	def predict_transcriptome_from_embed(self, z_shared, cond_emb_vec=None):
+		"""
+		Predict the transcriptome connected to an shared latent space with already embedded conditional covariates
+		:param z_shared: torch.tensor, shared latent representation
+		:param cond_emb_vec: None or torch.tensor shape=[batch_size, cond_dim], see get_cond_emb_vec
+		:return: torch.tensor, transcriptome profile
+		"""
+		if cond_emb_vec is not None:
 			z_shared = torch.cat([z_shared, cond_emb_vec], dim=-1)  # shape=[batch_size, zdim+cond_dim]
 		transcriptome_pred = self.rna_vae_decoder(z_shared)
 		transcriptome_pred = self.rna_decoder(transcriptome_pred)
@@ -166,6 +245,19 @@ class MoEModelTorch(nn.Module):
 		return z
 
 
+class MoELatentEncoder(nn.Module):
+	"""
+	Encoder-only part of MoEModelTorch, calculates the shared latent mean without sampling or decoding
+	"""
+	def __init__(self, model):
+		super(MoELatentEncoder, self).__init__()
+		self.model = model
+
+	def forward(self, rna, tcr, tcr_len, cond_emb_vec=None):
+		mu, _, _ = self.model._encode(rna, tcr, tcr_len, cond_emb_vec)
+		return self.model.get_latent_from_z(mu)  # shape=[batch_size, zdim]
+
+
 class MoEModel(VAEBaseModel):
 	def __init__(self,
 				 adata,
@@ -201,31 +293,54 @@ class MoEModel(VAEBaseModel):
 		self.params_joint['cond_dim'] = cond_dim
 		self.params_joint['cond_input'] = conditional is not None
 
-		self.model = MoEModelTorch(self.params_tcr, self.params_rna, self.params_joint)
+		# opt-in (torch>=2.0, MoE only): allocate the parameters directly on the target device instead of
+		# initializing them on the cpu. On GPU the initialization then draws from the CUDA RNG, so the initial
+		# weights differ from cpu initialized runs with the same seed.
+		init_on_device = 'init_on_device' in self.params_joint and self.params_joint['init_on_device']
+		device_context = contextlib.nullcontext()
+		if init_on_device and hasattr(torch, 'set_default_device'):
+			device_context = torch.device(self.device)
+		with device_context:
+			self.model = MoEModelTorch(self.params_tcr, self.params_rna, self.params_joint)
+		self._latent_encoder = None
+		self._compiled_latent_encoder = None
+
+	def get_latent_encoder(self):
+		"""
+		Compiled encoder-only module for calculating the mean shared latent space
+		:return: module taking (rna, tcr, tcr_len, cond_emb_vec) and returning the latent mean shape=[batch_size, zdim]
+		"""
+		if self._latent_encoder is None or self._latent_encoder.model is not self.model:
+			self._latent_encoder = MoELatentEncoder(self.model)
+			self._compiled_latent_encoder = self._latent_encoder
+			# torch>=2.0, fall back to eager mode for older versions
+			# the nested tensor fast path of the masked TCR encoder fails under torch.compile
+			mask_padding = 'mask_padding' in self.params_tcr and self.params_tcr['mask_padding']
+			if hasattr(torch, 'compile') and not mask_padding:
+				self._compiled_latent_encoder = torch.compile(self._latent_encoder, dynamic=False)
+		return self._compiled_latent_encoder
 
 	def calculate_loss(self, rna_pred, rna, tcr_pred, tcr):
 		rna_loss = self.loss_function_rna(rna_pred[0], rna) + self.loss_function_rna(rna_pred[1], rna)
 		rna_loss *= 0.5 * self.loss_weights[0]
 
+		# CrossEntropyLoss takes the classes in dim 1, transpose is a view, shape=[batch_size, num_seq_labels, seq_len]
 		# For GRU and Transformer, as they don't predict start token for alpha and beta chain, so amount of chains used
 		if tcr_pred[0].shape[1] == tcr.shape[1] - self.model.amount_chains:
-			mask = torch.ones_like(tcr).bool()
-			mask[:, [0]] = False
-			if not self.beta_only:
-				mask[:, [mask.shape[1] // 2]] = False
-			tcr_loss = self.loss_function_tcr(tcr_pred[0].flatten(end_dim=1), tcr[mask].flatten())
+			tcr_target = tcr.index_select(1, self.model.tcr_keep_idx)
+			tcr_loss = self.loss_function_tcr(tcr_pred[0].transpose(1, 2), tcr_target)
 			if not 'beta_only' in self.params_tcr or self.params_tcr['beta_only']:
-				tcr_loss += self.loss_function_tcr(tcr_pred[1].flatten(end_dim=1), tcr[mask].flatten())
-			tcr_loss *= 0.5 * self.loss_weights[1]
+				tcr_loss += self.loss_function_tcr(tcr_pred[1].transpose(1, 2), tcr_target)
 		else:  # For CNN, as it predicts start token
-			tcr_loss = (self.loss_function_tcr(tcr_pred[0].flatten(end_dim=1), tcr.flatten()) +
-						self.loss_function_tcr(tcr_pred[1].flatten(end_dim=1), tcr.flatten()))
-			tcr_loss *= 0.5 * self.loss_weights[1]
+			tcr_loss = (self.loss_function_tcr(tcr_pred[0].transpose(1, 2), tcr) +
+						self.loss_function_tcr(tcr_pred[1].transpose(1, 2), tcr))
+		tcr_loss *= 0.5 * self.loss_weights[1]
 		return rna_loss, tcr_loss
 
 	def calculate_kld_loss(self, mu, logvar, epoch):
-		kld_loss = (self.loss_function_kld(mu[0], logvar[0]) + self.loss_function_kld(mu[1], logvar[1]))
-		kld_loss *= 0.5 * self.loss_weights[2] * self.get_kl_annealing_factor(epoch)
+		# concatenate along the batch, the mean over both latents equals the average of both losses
+		kld_loss = self.loss_function_kld(torch.cat(mu, dim=0), torch.cat(logvar, dim=0))
+		kld_loss *= self.loss_weights[2] * self.get_kl_annealing_factor(epoch)
 		z = 0.5 * (mu[0] + mu[1])
 		return kld_loss, z
 
@@ -251,9 +366,10 @@ class MoEModel(VAEBaseModel):
 					conditional = conditional.to(self.device)
 				else:
 					conditional = None
-				z, mu, _, _, _ = self.model(rna, tcr, seq_len, conditional)
 				if return_mean:
-					z = mu
+					z, _ = self.model.encode(rna, tcr, seq_len, conditional)
+				else:
+					z, _, _, _, _ = self.model(rna, tcr, seq_len, conditional, need_reconstruction=False)
 				if modality == 'RNA':
 					z = z[0]
 				else:
@@ -51,6 +51,11 @@ class PoEModelTorch(nn.Module):
         # used for NB loss
         self.theta = torch.nn.Parameter(torch.randn(xdim))
 
+        # positions of the reconstruction targets, i.e. all except the first token of each chain
+        seq_len = tcr_params['max_tcr_length']
+        keep_idx = [i for i in range(seq_len * 2) if i % seq_len != 0]
+        self.register_buffer('tcr_keep_idx', torch.tensor(keep_idx, dtype=torch.long), persistent=False)
+
     def forward(self, rna, tcr, tcr_len, conditional=None):
         """
 		Forward pass of autoencoder
@@ -129,7 +134,7 @@ class PoEModelTorch(nn.Module):
         """
         std = torch.exp(0.5 * log_var)  # standard deviation
         eps = torch.randn_like(std)  # `randn_like` as we need the same size
-        z = mu + (eps * std)  # sampling as if coming from the input space
+        z = torch.addcmul(mu, eps, std)  # sampling as if coming from the input space, mu + eps * std in one kernel
         return z
 
     def product_of_experts(self, mu_rna, mu_tcr, logvar_rna, logvar_tcr):
@@ -207,10 +212,9 @@ class PoEModel(VAEBaseModel):
 
         # For GRU and Transformer, as they don't predict start token for alpha and beta chain, so -2
         if tcr_pred[0].shape[1] == tcr.shape[1] - 2:
-            mask = torch.ones_like(tcr).bool()
-            mask[:, [0, mask.shape[1] // 2]] = False
-            tcr_loss = (self.loss_function_tcr(tcr_pred[0].flatten(end_dim=1), tcr[mask].flatten()) +
-                        self.loss_function_tcr(tcr_pred[1].flatten(end_dim=1), tcr[mask].flatten()))
+            tcr_target = tcr.index_select(1, self.model.tcr_keep_idx).flatten()
+            tcr_loss = (self.loss_function_tcr(tcr_pred[0].flatten(end_dim=1), tcr_target) +
+                        self.loss_function_tcr(tcr_pred[1].flatten(end_dim=1), tcr_target))
             tcr_loss *= 0.5 * self.loss_weights[1]
         else:  # For CNN, as it predicts start token
             tcr_loss = (self.loss_function_tcr(tcr_pred[0].flatten(end_dim=1), tcr.flatten()) +
@@ -78,7 +78,7 @@ class RnaModelTorch(nn.Module):
 		"""
 		std = torch.exp(0.5 * log_var)  # standard deviation
 		eps = torch.randn_like(std)  # `randn_like` as we need the same size
-		z = mu + (eps * std)  # sampling as if coming from the input space
+		z = torch.addcmul(mu, eps, std)  # sampling as if coming from the input space, mu + eps * std in one kernel
 		return z
 
 	def predict_transcriptome(self, z_shared, conditional=None):
@@ -56,6 +56,11 @@ class SeparateModelTorch(nn.Module):
 		self.shared_decoder = MLP(zdim+cond_dim, hdim*num_modalities, shared_hidden[::-1], activation, activation,
 								  dropout, batch_norm, regularize_last_layer=True)
 
+		# positions of the reconstruction targets, i.e. all except the first token of each chain
+		seq_len = tcr_params['max_tcr_length']
+		keep_idx = [i for i in range(seq_len * 2) if i % seq_len != 0]
+		self.register_buffer('tcr_keep_idx', torch.tensor(keep_idx, dtype=torch.long), persistent=False)
+
 
 	def forward(self, rna, tcr, tcr_len, conditional=None):
 		"""
@@ -118,7 +123,7 @@ class SeparateModelTorch(nn.Module):
 		"""
 		std = torch.exp(0.5 * log_var)  # standard deviation
 		eps = torch.randn_like(std)  # `randn_like` as we need the same size
-		z = mu + (eps * std)  # sampling as if coming from the input space
+		z = torch.addcmul(mu, eps, std)  # sampling as if coming from the input space, mu + eps * std in one kernel
 		return z
 
 	def predict_transcriptome(self, z_shared, conditional=None):
@@ -184,9 +189,8 @@ class SeparateModel(VAEBaseModel):
 	def calculate_loss(self, rna_pred, rna, tcr_pred, tcr):
 		# For GRU and Transformer, as they don't predict start token for alpha and beta chain, so -2
 		if tcr_pred.shape[1] == tcr.shape[1] - 2:
-			mask = torch.ones_like(tcr).bool()
-			mask[:, [0, mask.shape[1] // 2]] = False
-			tcr_loss = self.loss_weights[1] * self.loss_function_tcr(tcr_pred.flatten(end_dim=1), tcr[mask].flatten())
+			tcr_target = tcr.index_select(1, self.model.tcr_keep_idx).flatten()
+			tcr_loss = self.loss_weights[1] * self.loss_function_tcr(tcr_pred.flatten(end_dim=1), tcr_target)
 		else:  # For CNN, as it predicts start token
 			tcr_loss = self.loss_weights[1] * self.loss_function_tcr(tcr_pred.flatten(end_dim=1), tcr.flatten())
 
@@ -10,9 +10,16 @@ def report_knn_prediction(adata, model, optimization_mode_params, epoch, comet):
     :param epoch: epoch number for logging
     :return: Reports externally to comet, saves model.
     """
-    test_embedding_func = get_model_prediction_function(model)
+    knn_backend = 'sklearn'
+    if 'knn_backend' in optimization_mode_params:
+        knn_backend = optimization_mode_params['knn_backend']
+    knn_compiled = False
+    if 'knn_compiled' in optimization_mode_params:
+        knn_compiled = optimization_mode_params['knn_compiled']
+    test_embedding_func = get_model_prediction_function(model, compiled=knn_compiled)
     summary = run_imputation_evaluation(adata, test_embedding_func, query_source='val',
-                                        label_pred=optimization_mode_params['prediction_column'])
+                                        label_pred=optimization_mode_params['prediction_column'],
+                                        knn_backend=knn_backend)
     metrics = summary['knn']
 
     if comet is not None:
@@ -91,6 +91,8 @@ class VAEBaseModel(ABC):
 		self.loss_weights = None
 		self.comet = None
 		self.kl_annealing_epochs = None
+		# set if the compiled latent encoder failed, further latent calculations then run in eager mode
+		self.compiled_latent_failed = False
 
 		# Model
 		self.model_type = None
@@ -307,21 +309,27 @@ class VAEBaseModel(ABC):
 		return False
 
 	# <- prediction functions ->
-	def get_latent(self, adata, metadata, return_mean=True):
+	def get_latent(self, adata, metadata, return_mean=True, compiled=False):
 		"""
 		Get latent
 		:param adata:
 		:param metadata: list of str, list of metadata that is needed, not really useful at the moment
 		:param return_mean: bool, calculate latent space without sampling
+		:param compiled: bool, use the compiled encoder-only module of the model if available (requires return_mean),
+			falls back to eager mode if compilation fails
 		:return: adata containing embedding vector in adata.X for each cell and the specified metadata in adata.obs
 		"""
 		data_embed = initialize_prediction_loader(adata, metadata, self.batch_size, beta_only=self.beta_only,
 												  conditional=self.conditional)
 
 		zs = []
+		out_of_memory_error = getattr(torch.cuda, 'OutOfMemoryError', ())  # torch>=1.13
 		with torch.no_grad():
 			self.model = self.model.to(self.device)
 			self.model.eval()
+			latent_encoder = None
+			if compiled and return_mean and not self.compiled_latent_failed:
+				latent_encoder = self.get_latent_encoder()
 			for rna, tcr, seq_len, _, labels, conditional in data_embed:
 				rna = rna.to(self.device)
 				tcr = tcr.to(self.device)
@@ -330,10 +338,33 @@ class VAEBaseModel(ABC):
 					conditional = conditional.to(self.device)
 				else:
 					conditional = None
-				z, mu, _, _, _ = self.model(rna, tcr, seq_len, conditional)
-				if return_mean:
-					z = mu
-				z = self.model.get_latent_from_z(z)
+				z = None
+				compile_error = None
+				if latent_encoder is not None:
+					cond_emb_vec = self.model.get_cond_emb_vec(conditional) if conditional is not None else None
+					try:
+						z = latent_encoder(rna, tcr, seq_len, cond_emb_vec)
+					except out_of_memory_error:
+						raise
+					except Exception as e:
+						# compilation errors only surface when calling the module, partly as plain errors of the
+						# generated code, errors that also occur in eager mode are raised by the eager path below
+						compile_error = e
+				if z is None and hasattr(self.model, 'encode'):  # skip decoding
+					if return_mean:
+						z, _ = self.model.encode(rna, tcr, seq_len, conditional)
+					else:
+						z, _, _, _, _ = self.model(rna, tcr, seq_len, conditional, need_reconstruction=False)
+					z = self.model.get_latent_from_z(z)
+				elif z is None:
+					z, mu, _, _, _ = self.model(rna, tcr, seq_len, conditional)
+					if return_mean:
+						z = mu
+					z = self.model.get_latent_from_z(z)
+				if compile_error is not None:  # the eager mode succeeded, so the failure is due to the compilation
+					print(f'Compiled latent encoder failed, falling back to eager mode: {compile_error}')
+					self.compiled_latent_failed = True
+					latent_encoder = None
 				z = sc.AnnData(z.detach().cpu().numpy())
 				# z.obs[metadata] = np.array(metadata_batch).T
 				zs.append(z)
@@ -342,20 +373,35 @@ class VAEBaseModel(ABC):
 		latent.obs[metadata] = adata.obs[metadata]
 		return latent
 
+	def get_latent_encoder(self):
+		"""
+		Compiled encoder-only module for calculating the mean latent space, implement this in the different model versions
+		:return: None if not supported by the model type, else module taking (rna, tcr, tcr_len, cond_emb_vec)
+		"""
+		return None
+
 	def predict_rna_from_latent(self, adata_latent, metadata=None):
 		data = initialize_latent_loader(adata_latent, self.batch_size, self.conditional)
 		rnas = []
 		with torch.no_grad():
 			model = self.model.to(self.device)
 			model.eval()
+			cond_emb_full = None
+			if self.conditional is not None and hasattr(model, 'predict_transcriptome_from_embed'):
+				# embed the conditional labels of all cells once instead of per batch
+				conditional_full = np.asarray(adata_latent.obsm[self.conditional]).argmax(1)
+				cond_emb_full = model.get_cond_emb_vec(torch.from_numpy(conditional_full).to(self.device))
+			idx = 0
 			for batch in data:
-				if self.conditional is not None:
-					batch = batch[0].to(self.device)
-					conditional = batch[1].to(self.device)
+				latent = batch[0].to(self.device)
+				if cond_emb_full is not None:
+					cond_emb_vec = cond_emb_full[idx:idx + latent.shape[0]]
+					batch_rna = model.predict_transcriptome_from_embed(latent, cond_emb_vec)
 				else:
-					batch = batch[0].to(self.device)
-					conditional = None
-				batch_rna = model.predict_transcriptome(batch, conditional)
+					# reduce the one-hot-encoding back to labels
+					conditional = batch[1].argmax(1).to(self.device) if self.conditional is not None else None
+					batch_rna = model.predict_transcriptome(latent, conditional)
+				idx += latent.shape[0]
 				batch_rna = sc.AnnData(batch_rna.detach().cpu().numpy())
 				rnas.append(batch_rna)
 		rnas = sc.AnnData.concatenate(*rnas)
@@ -56,31 +56,36 @@ def aa_encoding(adata, read_col, ohe_col=None, label_col=None, length_col=None,
 	else:
 		sequence_col = adata.obs[read_col]
 
-	# tokenize each character, i.e. create list of characters
-	aa_tokens = sequence_col.apply(lambda x: list(x))
+	# tokenize all sequences at once as a contiguous (n, pad_len) array of ascii codes
+	sequences = sequence_col.tolist()
+	if len(set(len(seq) for seq in sequences)) > 1:
+		raise ValueError(f'Sequences in {read_col} have different lengths, specify pad to encode them')
+	pad_len = len(sequences[0]) if len(sequences) > 0 else 0
+	joined = ''.join(sequences)
+	aa_tokens = np.frombuffer(joined.encode('ascii'), dtype=np.uint8).reshape(len(sequences), pad_len)
 
 	# dict containing aa name as key and token-id as value
 	if aa_to_id is None:
-		unique_aa_tokens = sorted(set([x for sublist in aa_tokens for x in sublist]))
+		unique_aa_tokens = sorted(set(joined))
 		aa_to_id = {aa: id_ for id_, aa in enumerate(unique_aa_tokens)}
 
-	# convert aa to token_id (i.e. unique integer for each aa)
-	token_ids = [[aa_to_id[token] for token in aa_token] for aa_token in aa_tokens]
+	# convert aa to token_id (i.e. unique integer for each aa) via a lookup table over the ascii codes
+	lut = np.full(128, -1, dtype=np.int16)
+	for aa, id_ in aa_to_id.items():
+		lut[ord(aa)] = id_
+	token_ids = lut[aa_tokens]
+	if (token_ids == -1).any():
+		unknown = sorted(set(chr(x) for x in aa_tokens[token_ids == -1]))
+		raise KeyError(f'Unknown tokens in {read_col}: {unknown}')
 
 	# convert token_ids to one-hot
 	if ohe_col is not None:
-		one_hot = [np.zeros((len(aa_token), len(aa_to_id))) for aa_token in aa_tokens]
-		for x_seq, token_id_seq in zip(one_hot, token_ids):
-			for x, token_id in zip(x_seq, token_id_seq):
-				x[token_id] = 1.0
-		# adata.obs[ohe_col] = one_hot
-		adata.obsm[ohe_col] = np.stack(one_hot)
-
-	# If specified write label as index sequence
+		# gather the rows of an identity matrix, shape=[n, pad_len, len(aa_to_id)]
+		adata.obsm[ohe_col] = np.eye(len(aa_to_id), dtype=np.float32)[token_ids]
+
+	# If specified write label as index sequence, using the smallest integer type fitting the vocabulary
 	if label_col is not None:
-		token_ids = [np.array(token_id) for token_id in token_ids]
-		# adata.obs[label_col] = token_ids
-		adata.obsm[label_col] = np.stack(token_ids)
+		adata.obsm[label_col] = token_ids.astype(np.int8 if len(aa_to_id) <= np.iinfo(np.int8).max else np.int16)
 
 	adata.uns['aa_to_id'] = aa_to_id
 
@@ -104,28 +109,32 @@ def stratified_group_shuffle_split(df, stratify_col, group_col, val_split, rando
 	:param stratify_col: str key for the column containing the classes to be stratified over all sets
 	:param group_col: str key for the column containing the groups to be kept in the same set
 	"""
-	groups = df.groupby(stratify_col)
-	all_train = []
-	all_test = []
-	for group_id, group in tqdm(groups):
+	groups = df.groupby(stratify_col).indices
+	group_col_values = df[group_col].values
+	all_train = set()
+	all_test = set()
+	for group_id, group_idx in tqdm(groups.items()):
 		# if a group is already taken in test or train it must stay there
-		group = group[~group[group_col].isin(all_train + all_test)]
+		mask = np.fromiter((g not in all_train and g not in all_test for g in group_col_values[group_idx]),
+						   dtype=bool, count=len(group_idx))
+		group_idx = group_idx[mask]
 		# if group is empty
-		if group.shape[0] == 0:
+		if len(group_idx) == 0:
 			continue
 
-		if len(group) > 1:
+		group_values = group_col_values[group_idx]
+		if len(group_idx) > 1:
 			train_inds, test_inds = next(
-				GroupShuffleSplit(test_size=val_split, n_splits=1, random_state=random_seed).split(group, groups=group[
-					group_col]))
-			all_train += group.iloc[train_inds][group_col].tolist()
-			all_test += group.iloc[test_inds][group_col].tolist()
+				GroupShuffleSplit(test_size=val_split, n_splits=1, random_state=random_seed).split(group_idx,
+																								   groups=group_values))
+			all_train.update(group_values[train_inds])
+			all_test.update(group_values[test_inds])
 		# if there is only one clonotype for this particular label
 		else:
-			all_train += group[group_col].tolist()
+			all_train.update(group_values)
 
-	train = df[df[group_col].isin(all_train)]
-	test = df[df[group_col].isin(all_test)]
+	train = df[df[group_col].map(all_train.__contains__).astype(bool)]
+	test = df[df[group_col].map(all_test.__contains__).astype(bool)]
 
 	return train, test
 